@@ -0,0 +1,59 @@
+"""
+Memory Mend - Export YOLOv8 weights to a TensorRT engine
+
+Run once at build time on the target GPU (engines are specific to the GPU
+model and TensorRT version they were built with), then start the server with
+MODEL_PATH=best.engine.
+
+Usage:
+    python export_engine.py                      # FP16 engine
+    python export_engine.py --int8 --data calib.yaml
+
+INT8 needs a calibration dataset: a YOLO data yaml whose `val` entry points at
+a folder of representative fabric photos. INT8 is not always faster — on
+small batches some heads regress in latency versus FP16, so benchmark both
+before switching a deployment over.
+"""
+
+import argparse
+import os
+
+from ultralytics import YOLO
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export YOLOv8 weights to TensorRT")
+    parser.add_argument("--weights", default=os.getenv("MODEL_PATH", "best.pt"),
+                        help="Path to the .pt weights (default: $MODEL_PATH or best.pt)")
+    parser.add_argument("--imgsz", type=int, default=640, help="Inference image size")
+    parser.add_argument("--batch", type=int, default=int(os.getenv("MAX_BATCH", 8)),
+                        help="Max batch size for the dynamic engine (default: $MAX_BATCH or 8, "
+                             "must be at least the server's MAX_BATCH)")
+    parser.add_argument("--int8", action="store_true", default=os.getenv("MM_PRECISION") == "int8",
+                        help="Build an INT8 engine (needs --data; default on when MM_PRECISION=int8)")
+    parser.add_argument("--data", help="Calibration data yaml for INT8")
+    args = parser.parse_args()
+
+    if args.int8 and not args.data:
+        parser.error("--int8 requires --data with calibration images")
+
+    if args.int8:
+        print("⚠️  INT8 can be slower than FP16 at small batch sizes - benchmark before deploying")
+
+    model = YOLO(args.weights)
+    engine_path = model.export(
+        format="engine",
+        imgsz=args.imgsz,
+        half=not args.int8,
+        int8=args.int8,
+        data=args.data,
+        dynamic=True,
+        batch=args.batch,
+    )
+
+    print(f"✅ Exported TensorRT engine: {engine_path}")
+    print(f"   Start the server with MODEL_PATH={os.path.basename(engine_path)}")
+
+
+if __name__ == "__main__":
+    main()
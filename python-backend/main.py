@@ -5,23 +5,64 @@ This server handles fabric damage detection using a fine-tuned YOLOv8 model.
 It accepts base64-encoded images and returns bounding box coordinates.
 """
 
-from fastapi import FastAPI, HTTPException
+import os
+
+# Requests already run in parallel (one OpenCV pipeline per CPU_EXECUTOR
+# thread), so stop OpenMP/BLAS from starting their own per-core thread pools
+# on top. These are read when numpy/torch load, so they are set first.
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(_var, "1")
+
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from ultralytics import YOLO
 from PIL import Image
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
-import base64
+import torch
+import asyncio
+import importlib.util
 import io
-import os
-from typing import List, Optional
+import threading
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+if TYPE_CHECKING:
+    from ultralytics import YOLO
+
+try:
+    # SIMD (SSSE3/AVX2) base64 decoder, API-compatible with the stdlib module
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start the /detect micro-batching worker for the lifetime of the app and
+    load the model in the background, so the server accepts connections (and
+    /health reports "degraded") while the weights are still loading.
+    """
+    global detect_queue
+    detect_queue = asyncio.Queue()
+    worker = asyncio.create_task(batch_worker())
+    asyncio.get_running_loop().run_in_executor(GPU_EXECUTOR, init_model)
+    yield
+    worker.cancel()
+
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Memory Mend Detection API",
     description="YOLOv8-based fabric damage detection service",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    # orjson serializes responses in C instead of the stdlib json encoder
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS (adjust origins for production)
@@ -39,15 +80,218 @@ app.add_middleware(
 )
 
 # Load YOLOv8 model once at startup
+# MODEL_PATH can point at the PyTorch weights (best.pt) or at a TensorRT
+# engine (best.engine) built with export_engine.py
 MODEL_PATH = os.getenv("MODEL_PATH", "best.pt")
-print(f"Loading YOLOv8 model from {MODEL_PATH}...")
-try:
-    model = YOLO(MODEL_PATH)
+
+# Inference precision: fp16 or fp32 for .pt weights; int8 only applies to
+# TensorRT engines, where the precision is fixed at export time.
+# FP16 is only used on CUDA - half precision on CPU is slower, not faster.
+PRECISION = os.getenv("MM_PRECISION", "fp16").lower()
+if PRECISION not in ("fp16", "fp32", "int8"):
+    print(f"⚠️  Unknown MM_PRECISION '{PRECISION}', using fp32")
+    PRECISION = "fp32"
+DEVICE = 0 if torch.cuda.is_available() else "cpu"
+
+# Uvicorn worker processes. One per node is the intended deployment: each
+# worker holds its own model (and CUDA context) and batches only its own
+# requests, while a single worker already overlaps requests on its thread pools
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+
+# OpenCV calls are small and already spread across CPU_EXECUTOR threads; its
+# internal thread pool only adds fork/join overhead and contention
+cv2.setNumThreads(1)
+# The model call is the one place intra-op threads pay off: give it this
+# worker's share of the cores (OMP_NUM_THREADS=1 above would otherwise pin it)
+torch.set_num_threads(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))
+USE_HALF = PRECISION == "fp16" and DEVICE != "cpu"
+
+# Optional comma-separated class ids to keep (e.g. "0,1,3"); filtered before NMS
+DETECT_CLASSES = [int(c) for c in os.getenv("MM_CLASSES", "").split(",") if c.strip()] or None
+
+# Export .pt weights on first boot and load the cached export from then on:
+# a TensorRT engine on CUDA hosts, ONNX Runtime on CPU-only hosts
+# (MM_AUTO_EXPORT=0 to always serve the .pt weights)
+AUTO_EXPORT = os.getenv("MM_AUTO_EXPORT", "1").lower() not in ("0", "false", "no")
+
+# Opt-in: replay single-image /detect batches from a captured CUDA graph
+# (PyTorch .pt weights on CUDA only; TensorRT engines are already fused)
+USE_CUDA_GRAPH = os.getenv("MM_CUDA_GRAPH", "0").lower() in ("1", "true", "yes")
+
+# Formats load_model loads with YOLO(path, task="detect"), falling back to .pt
+EXPORTED_SUFFIXES = (".engine", ".onnx")
+
+
+def export_settings(path: str) -> Optional[tuple]:
+    """
+    Return (export path, model.export kwargs) for auto-exporting the .pt
+    weights at path on this host, or None to serve the weights as-is.
+    """
+    # MM_CUDA_GRAPH explicitly asks for the PyTorch model
+    if not AUTO_EXPORT or USE_CUDA_GRAPH or not path.endswith(".pt"):
+        return None
+
+    base = os.path.splitext(path)[0]
+    if DEVICE == "cpu":
+        # Dynamic batch so micro-batched requests run in one session call
+        return base + ".onnx", dict(format="onnx", dynamic=True, simplify=True)
+
+    # INT8 engines need calibration data, so those are only built by hand
+    if PRECISION == "int8":
+        return None
+    # TensorRT is an optional, CUDA-only install (see README); without it
+    # Ultralytics would try to pip-install it in the middle of boot
+    if importlib.util.find_spec("tensorrt") is None:
+        print("⚠️  tensorrt is not installed, serving the .pt weights "
+              "(pip install tensorrt to auto-export an engine)")
+        return None
+    return base + ".engine", dict(format="engine", half=USE_HALF, dynamic=True,
+                                  batch=MAX_BATCH, workspace=4, device=DEVICE)
+
+
+def export_weights(weights: "YOLO", export_path: str, export_args: dict) -> bool:
+    """
+    Export the loaded .pt weights to export_path (next to the weights, where
+    Ultralytics writes exports). Returns False on failure.
+    """
+    print(f"Exporting {export_path} (first boot only, this can take a few minutes)...")
+    try:
+        weights.export(imgsz=weights.overrides.get("imgsz", 640), **export_args)
+    except Exception as e:
+        print(f"⚠️  Export to {export_path} failed ({e}), serving the .pt weights")
+        return False
+    return os.path.exists(export_path)
+
+
+def load_model(path: str) -> "YOLO":
+    """
+    Load YOLOv8 weights, a TensorRT engine or an ONNX model. .pt weights are
+    swapped for the export next to them (see export_settings), built on
+    first use. Falls back to the .pt weights next to an export that fails
+    to load or run (e.g. no TensorRT runtime, an engine built for a different
+    GPU, or a truncated file).
+    """
+    # Imported here so the module (and the server) come up without paying
+    # for the ultralytics import until the model is actually loaded
+    from ultralytics import YOLO
+
+    if not path.endswith(EXPORTED_SUFFIXES):
+        if PRECISION == "int8":
+            print("⚠️  MM_PRECISION=int8 needs a TensorRT engine, running in fp32")
+        export = export_settings(path)
+        if export and os.path.exists(export[0]):
+            return load_model(export[0])
+
+        weights = YOLO(path)
+        if export and export_weights(weights, *export):
+            return load_model(export[0])
+        return weights
+
+    try:
+        exported = YOLO(path, task="detect")
+        # YOLO() only records the path; the file is opened by the first
+        # predict, so run one here to surface a broken export at startup
+        imgsz = exported.overrides.get("imgsz", 640)
+        imgsz = max(imgsz) if isinstance(imgsz, (list, tuple)) else imgsz
+        exported.predict(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), imgsz=imgsz,
+                         half=USE_HALF, device=DEVICE, save=False, verbose=False)
+        return exported
+    except Exception as e:
+        fallback = os.path.splitext(path)[0] + ".pt"
+        if not os.path.exists(fallback):
+            raise
+        print(f"⚠️  Could not load {path} ({e}), falling back to {fallback} "
+              f"(delete {path} to rebuild it)")
+        return YOLO(fallback)
+
+
+# Set by init_model once loading finishes; /detect returns 503 until then
+model = None
+
+# Inference size the weights were trained/exported at; every request is
+# letterboxed to fit it on the CPU before it reaches the model
+MODEL_IMGSZ = 640
+
+# Network stride when the model takes rectangular input (.pt weights and
+# dynamic-shape exports): images are then padded only up to a multiple of it,
+# like Ultralytics' default "rect" letterbox. None pads to the full
+# MODEL_IMGSZ square, which static exports and the fixed-shape CUDA graph need.
+RECT_STRIDE: Optional[int] = None
+
+
+def rect_stride(loaded: "YOLO") -> Optional[int]:
+    """
+    Return the stride rect letterboxes are padded to for this model, or None
+    if it only takes a fixed MODEL_IMGSZ square (as Ultralytics' predictor
+    decides for LetterBox(auto=...)).
+    """
+    if isinstance(loaded.model, torch.nn.Module):
+        return max(int(loaded.model.stride.max()), 32)
+    # Exports: the AutoBackend set up by load_model's warm-up predict knows
+    # whether the file has dynamic input shapes
+    backend = getattr(loaded.predictor, "model", None)
+    if backend is not None and getattr(backend, "dynamic", False):
+        return max(int(backend.stride), 32)
+    return None
+
+
+def init_model():
+    """Load the model at startup (runs on GPU_EXECUTOR, off the event loop)"""
+    global model, MODEL_IMGSZ, RECT_STRIDE, PINNED_INPUT, CUDA_STREAM, CUDA_GRAPH
+
+    if WEB_CONCURRENCY > 1:
+        print(f"⚠️  WEB_CONCURRENCY={WEB_CONCURRENCY}: each worker loads its own model and "
+              "batches separately; one worker per node is recommended")
+    print(f"Loading YOLOv8 model from {MODEL_PATH} (device: {DEVICE}, fp16: {USE_HALF})...")
+    try:
+        loaded = load_model(MODEL_PATH)
+    except Exception as e:
+        print(f"❌ Error loading model: {e}")
+        print("⚠️  Server will keep running but /detect endpoint will fail")
+        return
+
+    imgsz = loaded.overrides.get("imgsz", 640)
+    MODEL_IMGSZ = max(imgsz) if isinstance(imgsz, (list, tuple)) else imgsz
+    if DEVICE != "cpu":
+        PINNED_INPUT = torch.empty((MAX_BATCH, 3, MODEL_IMGSZ, MODEL_IMGSZ),
+                                   dtype=torch.uint8, pin_memory=True)
+        CUDA_STREAM = torch.cuda.Stream()
+
+    if USE_CUDA_GRAPH:
+        if DEVICE == "cpu" or not isinstance(loaded.model, torch.nn.Module):
+            print("⚠️  MM_CUDA_GRAPH needs .pt weights on a CUDA GPU, using model.predict")
+        else:
+            try:
+                CUDA_GRAPH = capture_cuda_graph(loaded.model)
+                print("✅ Captured CUDA graph for batch size 1")
+            except Exception as e:
+                print(f"⚠️  CUDA graph capture failed ({e}), using model.predict")
+    if CUDA_GRAPH is None:
+        RECT_STRIDE = rect_stride(loaded)
+    # Publish the model last, so requests never see it with a stale MODEL_IMGSZ
+    model = loaded
     print("✅ Model loaded successfully!")
-except Exception as e:
-    print(f"❌ Error loading model: {e}")
-    print("⚠️  Server will start but /detect endpoint will fail")
-    model = None
+
+# Micro-batching: /detect requests arriving within MAX_WAIT_MS of each other
+# are coalesced into one model.predict call of up to MAX_BATCH images (one call
+# per letterboxed shape)
+MAX_BATCH = int(os.getenv("MAX_BATCH", 8))
+MAX_WAIT_MS = float(os.getenv("MAX_WAIT_MS", 5))
+detect_queue: Optional[asyncio.Queue] = None
+
+# Blocking work runs off the event loop: decoding and the OpenCV pattern
+# pipeline on a shared CPU pool, model calls on a single dedicated thread
+CPU_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+GPU_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+# CUDA only: page-locked staging buffer for batches on their way to the GPU and
+# a dedicated stream for the copy and the forward pass. Both are allocated once
+# by init_model and only ever touched from the GPU_EXECUTOR thread.
+PINNED_INPUT: Optional[torch.Tensor] = None
+CUDA_STREAM: Optional["torch.cuda.Stream"] = None
+
+# (graph, static input, static output) when MM_CUDA_GRAPH capture succeeded
+CUDA_GRAPH: Optional[tuple] = None
 
 
 # Request/Response models
@@ -87,31 +331,283 @@ class PatternDetectionResponse(BaseModel):
     debug_image: Optional[str] = None
 
 
+# libjpeg can decode straight to 1/2, 1/4 or 1/8 scale during the IDCT
+REDUCED_DECODE_FLAGS = {
+    cv2.IMREAD_GRAYSCALE: ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                           (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                           (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)),
+    cv2.IMREAD_COLOR: ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                       (4, cv2.IMREAD_REDUCED_COLOR_4),
+                       (2, cv2.IMREAD_REDUCED_COLOR_2)),
+}
+
+
+def decode_with_pil(image_bytes: bytes, grayscale: bool) -> Optional[np.ndarray]:
+    """
+    Decode formats OpenCV has no codec for (GIF, for example) with PIL, as
+    the server did before switching to cv2.imdecode. Returns None on failure.
+    """
+    try:
+        rgb = np.asarray(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
+    except Exception:
+        return None
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY if grayscale else cv2.COLOR_RGB2BGR)
+
+
+def decode_image_bytes(image_bytes: bytes, flags: int = cv2.IMREAD_COLOR,
+                       min_side: Optional[int] = None) -> np.ndarray:
+    """
+    Decode encoded image bytes (JPEG, PNG, ...) to an OpenCV image array.
+    Returns BGR by default, or a single-channel image with cv2.IMREAD_GRAYSCALE.
+    With min_side, large images are decoded at the smallest 1/2, 1/4 or 1/8
+    reduction whose long side is still at least min_side.
+    """
+    grayscale = flags == cv2.IMREAD_GRAYSCALE
+    if min_side is not None and flags in REDUCED_DECODE_FLAGS:
+        try:
+            # Header-only read, no pixel data is decoded here
+            long_side = max(Image.open(io.BytesIO(image_bytes)).size)
+        except Exception:
+            long_side = 0
+        for factor, reduced_flags in REDUCED_DECODE_FLAGS[flags]:
+            if long_side // factor >= min_side:
+                flags = reduced_flags
+                break
+
+    try:
+        # EXIF orientation is ignored, as PIL did before
+        image = cv2.imdecode(
+            np.frombuffer(image_bytes, np.uint8),
+            flags | cv2.IMREAD_IGNORE_ORIENTATION
+        )
+    except Exception as e:
+        raise ValueError(f"Failed to decode image: {str(e)}")
+
+    if image is None:
+        # Not a format OpenCV reads; PIL's full-size decode is the fallback
+        image = decode_with_pil(image_bytes, grayscale)
+    if image is None:
+        raise ValueError("Failed to decode image: unsupported or corrupt image data")
+
+    return image
+
+
 # Helper function to decode base64 image
-def decode_base64_image(base64_string: str) -> Image.Image:
+# Data URI headers ("data:<mime>;base64,") are short, so the comma is looked
+# for here first; longer prefixes fall back to searching the whole string
+DATA_URI_HEADER_MAX = 256
+
+
+def decode_base64_ndarray(base64_string: str, flags: int = cv2.IMREAD_COLOR,
+                          min_side: Optional[int] = None) -> np.ndarray:
     """
-    Decode base64 string to PIL Image.
+    Decode base64 string straight to an OpenCV image array.
     Handles data URI format (e.g., "data:image/jpeg;base64,...")
+    See decode_image_bytes for flags and min_side.
     """
     try:
-        # Remove data URI prefix if present
-        if "," in base64_string:
-            base64_string = base64_string.split(",")[1]
+        # base64 never contains ",", so any comma ends a data URI prefix
+        comma = base64_string.find(",", 0, DATA_URI_HEADER_MAX)
+        if comma < 0:
+            comma = base64_string.find(",")
+
+        # Encoding to bytes is the one copy of the payload; the prefix is
+        # then sliced off through a memoryview instead of copying it again
+        encoded = base64_string.encode("ascii")
 
         # Decode base64
-        image_bytes = base64.b64decode(base64_string)
+        image_bytes = base64.b64decode(memoryview(encoded)[comma + 1:], validate=False)
+
+    except Exception as e:
+        raise ValueError(f"Failed to decode image: {str(e)}")
 
-        # Open as PIL Image
-        image = Image.open(io.BytesIO(image_bytes))
+    return decode_image_bytes(image_bytes, flags, min_side)
 
-        # Convert to RGB if necessary
-        if image.mode != "RGB":
-            image = image.convert("RGB")
 
-        return image
+# ==================== BATCHED INFERENCE ====================
 
-    except Exception as e:
-        raise ValueError(f"Failed to decode image: {str(e)}")
+def letterbox(image: np.ndarray, size: int, stride: Optional[int] = None):
+    """
+    Resize keeping aspect ratio and pad, as YOLO's LetterBox does: to
+    size x size, or with stride only up to the next multiple of stride
+    (LetterBox(auto=True)).
+    Returns (padded image, (x, y) scale ratios, (pad_x, pad_y)) to map boxes back.
+    """
+    h, w = image.shape[:2]
+    ratio = min(size / h, size / w)
+    new_w, new_h = round(w * ratio), round(h * ratio)
+    if (new_w, new_h) != (w, h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+
+    pad_w, pad_h = size - new_w, size - new_h
+    if stride:
+        pad_w, pad_h = pad_w % stride, pad_h % stride
+    pad_x, pad_y = pad_w / 2, pad_h / 2
+    top, bottom = round(pad_y - 0.1), round(pad_y + 0.1)
+    left, right = round(pad_x - 0.1), round(pad_x + 0.1)
+    padded = cv2.copyMakeBorder(image, top, bottom, left, right,
+                                cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    # Per-axis ratios of the rounded resize, as Ultralytics' scale_boxes uses
+    return padded, (new_w / w, new_h / h), (left, top)
+
+
+def prepare_detection_input(decode: Callable, data):
+    """
+    Decode an upload and letterbox it to MODEL_IMGSZ (runs on CPU_EXECUTOR).
+    Returns ((height, width) of the original image, padded image, ratio, pad).
+    """
+    image = decode(data)
+    padded, ratio, pad = letterbox(image, MODEL_IMGSZ, RECT_STRIDE)
+    return image.shape[:2], padded, ratio, pad
+
+
+def to_model_input(images: list) -> torch.Tensor:
+    """
+    Stack same-shape letterboxed BGR images into a normalized RGB BCHW tensor.
+    Pixels travel to the device as uint8 and are converted there.
+    """
+    if PINNED_INPUT is not None:
+        # Write straight into the pinned buffer so the upload is an async DMA
+        # (rect letterboxes are at most MODEL_IMGSZ square, so they fit in it)
+        h, w = images[0].shape[:2]
+        staging = PINNED_INPUT.view(-1)[:len(images) * 3 * h * w].view(len(images), 3, h, w)
+        staging_np = staging.numpy()
+        for i, image in enumerate(images):
+            staging_np[i] = image[..., ::-1].transpose(2, 0, 1)
+        tensor = staging.to(DEVICE, non_blocking=True)
+    else:
+        batch = np.ascontiguousarray(np.stack(images)[..., ::-1].transpose(0, 3, 1, 2))
+        tensor = torch.from_numpy(batch).to(DEVICE)
+    tensor = tensor.half() if USE_HALF else tensor.float()
+    return tensor.div_(255)
+
+
+def capture_cuda_graph(net: torch.nn.Module) -> tuple:
+    """
+    Record a batch-1 forward pass of the detection network as a CUDA graph.
+    Replaying it skips the per-layer kernel launches that dominate latency
+    for single images. Returns (graph, static input, static output).
+    """
+    net = net.to(DEVICE).fuse(verbose=False).eval()
+    net = net.half() if USE_HALF else net.float()
+    dtype = torch.float16 if USE_HALF else torch.float32
+    static_in = torch.zeros((1, 3, MODEL_IMGSZ, MODEL_IMGSZ), dtype=dtype, device=DEVICE)
+
+    # Warm up on a side stream so cuDNN autotuning and allocator growth
+    # happen before capture, as the PyTorch CUDA graph docs recommend
+    side = torch.cuda.Stream()
+    side.wait_stream(torch.cuda.current_stream())
+    with torch.inference_mode(), torch.cuda.stream(side):
+        for _ in range(3):
+            net(static_in)
+    torch.cuda.current_stream().wait_stream(side)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.inference_mode(), torch.cuda.graph(graph):
+        static_out = net(static_in)
+    # Eval-mode forward returns (predictions, raw head outputs)
+    if isinstance(static_out, (list, tuple)):
+        static_out = static_out[0]
+    return graph, static_in, static_out
+
+
+def replay_cuda_graph(image: np.ndarray, confidence: float) -> list:
+    """
+    Run one letterboxed image through the captured CUDA graph and apply the
+    same NMS model.predict would, returning a one-element Results list.
+    """
+    try:
+        from ultralytics.utils.ops import non_max_suppression
+    except ImportError:  # moved to ultralytics.utils.nms in 8.4
+        from ultralytics.utils.nms import non_max_suppression
+    from ultralytics.engine.results import Results
+
+    graph, static_in, static_out = CUDA_GRAPH
+    static_in.copy_(to_model_input([image]))
+    graph.replay()
+    # NMS runs on the GPU; its output is a fresh tensor, so the next replay
+    # overwriting static_out cannot clobber these detections
+    preds = non_max_suppression(static_out, confidence, 0.7, classes=DETECT_CLASSES, max_det=300)
+    return [Results(image, path="", names=model.names, boxes=preds[0])]
+
+
+def run_inference(images: list, confidence: float) -> list:
+    """
+    Run YOLOv8 on a batch of same-shape letterboxed images, returning one
+    Results object per image. Boxes are in letterboxed coordinates.
+    """
+    # torch.cuda.stream(None) is a no-op, so this is safe on CPU
+    with torch.inference_mode(), torch.cuda.stream(CUDA_STREAM):
+        if CUDA_GRAPH is not None and len(images) == 1:
+            results = replay_cuda_graph(images[0], confidence)
+        else:
+            results = model.predict(
+                to_model_input(images),
+                conf=confidence,
+                imgsz=MODEL_IMGSZ,
+                classes=DETECT_CLASSES,
+                half=USE_HALF,
+                device=DEVICE,
+                save=False,
+                verbose=False
+            )
+
+    if CUDA_STREAM is not None:
+        # Results are read on the event loop thread (default stream), and the
+        # pinned buffer is refilled by the next batch, so finish here
+        CUDA_STREAM.synchronize()
+    return results
+
+
+async def batch_worker():
+    """
+    Drain the detection queue in batches.
+    Waits for one request, then collects more for up to MAX_WAIT_MS (or until
+    MAX_BATCH is reached) and runs them through the model together.
+    """
+    loop = asyncio.get_running_loop()
+
+    while True:
+        batch = [await detect_queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(detect_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Rect letterboxes differ with aspect ratio; one model call per shape
+        groups = {}
+        for item in batch:
+            groups.setdefault(item[0].shape, []).append(item)
+
+        for group in groups.values():
+            images = [image for image, _, _ in group]
+            # Run at the lowest requested confidence; each request filters its own
+            confidence = min(conf for _, conf, _ in group)
+
+            try:
+                results = await loop.run_in_executor(GPU_EXECUTOR, run_inference, images, confidence)
+            except Exception as e:
+                for _, _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, _, future), result in zip(group, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+async def predict_batched(image, confidence: float):
+    """Queue an image for the batch worker and wait for its Results"""
+    future = asyncio.get_running_loop().create_future()
+    await detect_queue.put((image, confidence, future))
+    return await future
 
 
 # API Endpoints
@@ -146,6 +642,34 @@ async def detect_damage(request: DetectionRequest):
     Returns:
         DetectionResponse with bounding boxes and metadata
     """
+    return await run_detection(decode_base64_ndarray, request.image, request.confidence_threshold)
+
+
+@app.post("/detect-bytes", response_model=DetectionResponse)
+async def detect_damage_bytes(
+    file: UploadFile = File(...),
+    confidence_threshold: Optional[float] = Form(0.3)
+):
+    """
+    Detect fabric damage in an image uploaded as multipart/form-data.
+    Preferred over /detect: no base64 inflation or decode on either side.
+
+    Args:
+        file: Encoded image file (JPEG, PNG, ...)
+        confidence_threshold: Min confidence for detections
+
+    Returns:
+        DetectionResponse with bounding boxes and metadata
+    """
+    image_bytes = await file.read()
+    return await run_detection(decode_image_bytes, image_bytes, confidence_threshold)
+
+
+async def run_detection(decode: Callable, data, min_confidence: Optional[float]):
+    """
+    Shared /detect pipeline: decode the upload with the given decoder,
+    run batched inference and build the response.
+    """
     if model is None:
         raise HTTPException(
             status_code=503,
@@ -153,54 +677,59 @@ async def detect_damage(request: DetectionRequest):
         )
 
     try:
-        # Decode image
-        image = decode_base64_image(request.image)
-        image_width, image_height = image.size
+        # Decode and letterbox to the model input size
+        (image_height, image_width), padded, (ratio_x, ratio_y), (pad_x, pad_y) = \
+            await asyncio.get_running_loop().run_in_executor(
+                CPU_EXECUTOR, prepare_detection_input, decode, data
+            )
+        if min_confidence is None:
+            min_confidence = 0.3
 
-        # Run YOLOv8 inference
+        # Run YOLOv8 inference (batched with other concurrent requests)
         print(f"Running detection on {image_width}x{image_height} image...")
-        results = model.predict(
-            image,
-            conf=request.confidence_threshold,
-            verbose=False
-        )
+        result = await predict_batched(padded, min_confidence)
 
         # Parse results
         detections = []
-
-        # YOLOv8 returns a list of Results objects
-        if len(results) > 0:
-            result = results[0]
-
-            # Extract bounding boxes
-            if result.boxes is not None and len(result.boxes) > 0:
-                for box in result.boxes:
-                    # Get box coordinates in xyxy format
-                    xyxy = box.xyxy[0].cpu().numpy()  # [x1, y1, x2, y2]
-
-                    # Convert to x, y, width, height
-                    x1, y1, x2, y2 = map(int, xyxy)
-                    width = x2 - x1
-                    height = y2 - y1
-
-                    # Get confidence and class
-                    confidence = float(box.conf[0])
-                    class_id = int(box.cls[0])
-                    class_name = model.names[class_id]
-
-                    detections.append(Detection(
-                        bbox=BoundingBox(x=x1, y=y1, width=width, height=height),
-                        confidence=confidence,
-                        class_name=class_name
-                    ))
+        boxes = result.boxes
+
+        if boxes is not None and len(boxes) > 0:
+            # Copy each tensor to the host once instead of three syncs per box
+            xyxy = boxes.xyxy.cpu().numpy()  # [x1, y1, x2, y2] in letterboxed coords
+
+            # Undo the letterbox and clip to the original image
+            xyxy = (xyxy - (pad_x, pad_y, pad_x, pad_y)) / (ratio_x, ratio_y, ratio_x, ratio_y)
+            xyxy = np.clip(xyxy, 0, (image_width, image_height, image_width, image_height))
+            xyxy = xyxy.astype(np.int32)
+            confidences = boxes.conf.cpu().numpy()
+            class_ids = boxes.cls.cpu().numpy().astype(np.int32)
+
+            # Skip boxes below this request's threshold
+            keep = confidences >= min_confidence
+
+            # Field types are already exact, so skip Pydantic validation
+            detections = [
+                Detection.model_construct(
+                    bbox=BoundingBox.model_construct(
+                        x=int(x1), y=int(y1), width=int(x2 - x1), height=int(y2 - y1)
+                    ),
+                    confidence=float(confidence),
+                    class_name=model.names[int(class_id)]
+                )
+                for (x1, y1, x2, y2), confidence, class_id
+                in zip(xyxy[keep], confidences[keep], class_ids[keep])
+            ]
 
         print(f"✅ Found {len(detections)} detection(s)")
 
-        return DetectionResponse(
+        # Returning a Response skips FastAPI's response_model re-validation;
+        # response_model is kept on the route for the OpenAPI schema
+        response = DetectionResponse.model_construct(
             detections=detections,
             image_width=image_width,
             image_height=image_height
         )
+        return ORJSONResponse(content=response.model_dump())
 
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -220,14 +749,10 @@ def order_points(pts):
     Order points: [top-left, top-right, bottom-right, bottom-left]
     Essential for consistent perspective transform.
     """
-    rect = np.zeros((4, 2), dtype="float32")
-    s = pts.sum(axis=1)
-    rect[0] = pts[np.argmin(s)]  # top-left
-    rect[2] = pts[np.argmax(s)]  # bottom-right
-    diff = np.diff(pts, axis=1)
-    rect[1] = pts[np.argmin(diff)]  # top-right
-    rect[3] = pts[np.argmax(diff)]  # bottom-left
-    return rect
+    s = pts[:, 0] + pts[:, 1]
+    d = pts[:, 0] - pts[:, 1]
+    # top-left, top-right, bottom-right, bottom-left
+    return pts[[np.argmin(s), np.argmax(d), np.argmax(s), np.argmin(d)]].astype("float32")
 
 
 def four_point_transform(image, pts):
@@ -235,16 +760,12 @@ def four_point_transform(image, pts):
     Apply perspective transform to crop and straighten region.
     """
     rect = order_points(pts)
-    (tl, tr, br, bl) = rect
 
-    # Calculate dimensions
-    width_top = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-    width_bottom = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-    max_width = max(int(width_top), int(width_bottom))
-
-    height_left = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-    height_right = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-    max_height = max(int(height_left), int(height_right))
+    # Calculate dimensions from the top, bottom, left and right edge lengths
+    edges = rect[[1, 2, 3, 2]] - rect[[0, 3, 0, 1]]
+    lengths = np.hypot(edges[:, 0], edges[:, 1])
+    max_width = int(max(lengths[0], lengths[1]))
+    max_height = int(max(lengths[2], lengths[3]))
 
     dst = np.array([
         [0, 0],
@@ -261,24 +782,51 @@ def four_point_transform(image, pts):
 
 # ==================== PATTERN DETECTION FUNCTIONS ====================
 
-def find_fiducials(image_gray: np.ndarray) -> dict:
+# Large photos are downscaled to this long side before pattern detection.
+# Fiducials and cells are large, and dark pixel ratios are scale-invariant.
+PATTERN_MAX_SIDE = 1024
+
+# Per-thread scratch images for the pattern pipeline, so CPU_EXECUTOR threads
+# reuse their buffers across requests instead of reallocating them each time
+_pattern_scratch = threading.local()
+
+
+def scratch_buffer(name: str, shape: tuple) -> np.ndarray:
+    """
+    Return this thread's uint8 buffer called name, reallocated only when the
+    shape changes (one buffer per name keeps memory bounded).
+    """
+    buf = getattr(_pattern_scratch, name, None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+        setattr(_pattern_scratch, name, buf)
+    return buf
+
+
+@lru_cache(maxsize=None)
+def structuring_element(shape: int, size: int) -> np.ndarray:
+    """
+    Return a cached size x size cv2 structuring element; kernel sizes are
+    derived from image size, so only a handful are ever built.
+    """
+    return cv2.getStructuringElement(shape, (size, size))
+
+
+def find_fiducials(binary: np.ndarray) -> dict:
     """
     Find the 4 corner fiducials by searching each corner region separately.
-    Uses Otsu threshold and region-based detection.
+    Takes the Otsu-thresholded image and uses region-based detection.
     Returns dict with {tl, tr, bl, br} containing bounding box info.
     """
-    h, w = image_gray.shape[:2]
-
-    # Use Otsu threshold instead of hard-coded
-    blurred = cv2.GaussianBlur(image_gray, (5, 5), 0)
-    _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    h, w = binary.shape[:2]
 
     # Apply morphological closing for larger images only
+    # (returns a new image; the caller's binary stays unclosed for grid decoding)
     if min(h, w) > 800:
         kernel_size = max(3, int(min(h, w) * 0.008))
         if kernel_size % 2 == 0:
             kernel_size += 1
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
+        kernel = structuring_element(cv2.MORPH_ELLIPSE, kernel_size)
         binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
 
     # Define corner regions with 18% margin
@@ -294,19 +842,23 @@ def find_fiducials(image_gray: np.ndarray) -> dict:
 
     for corner, (y1, y2, x1, x2) in corners.items():
         region = binary[y1:y2, x1:x2]
-        contours, _ = cv2.findContours(region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Thin or tiny images leave an empty corner, and labelling a 0x0
+        # image crashes OpenCV (segfault), so skip it
+        if margin <= 0 or region.size == 0:
+            continue
+        # One labelling pass gives every blob's bounding box and pixel area
+        n, _, stats, _ = cv2.connectedComponentsWithStats(region, connectivity=8, ltype=cv2.CV_32S)
 
-        if not contours:
+        if n <= 1:
             continue
 
-        # Merge nearby contours if multiple exist
-        if len(contours) > 1:
-            contours_sorted = sorted(contours, key=cv2.contourArea, reverse=True)[:3]
-            all_points = np.vstack(contours_sorted)
-            bx, by, bw, bh = cv2.boundingRect(all_points)
-        else:
-            best = max(contours, key=cv2.contourArea)
-            bx, by, bw, bh = cv2.boundingRect(best)
+        # Merge nearby blobs: union of the bounding boxes of the 3 largest
+        blobs = stats[1:]  # label 0 is the background
+        top = blobs[np.argsort(-blobs[:, cv2.CC_STAT_AREA], kind="stable")[:3]]
+        bx = int(top[:, cv2.CC_STAT_LEFT].min())
+        by = int(top[:, cv2.CC_STAT_TOP].min())
+        bw = int((top[:, cv2.CC_STAT_LEFT] + top[:, cv2.CC_STAT_WIDTH]).max()) - bx
+        bh = int((top[:, cv2.CC_STAT_TOP] + top[:, cv2.CC_STAT_HEIGHT]).max()) - by
 
         # Adjust coordinates back to full image
         bx += x1
@@ -337,7 +889,7 @@ def normalize_fiducial_sizes(fiducials: dict) -> dict:
     square_fids = [(c, a, s, w, h) for c, a, s, w, h in fid_info if a < 1.3]
 
     if not square_fids:
-        square_fids = sorted(fid_info, key=lambda x: x[1])[:1]
+        square_fids = [min(fid_info, key=lambda x: x[1])]
 
     target_size = int(sum(s for _, _, s, _, _ in square_fids) / len(square_fids))
 
@@ -362,16 +914,17 @@ def normalize_fiducial_sizes(fiducials: dict) -> dict:
 
     return normalized
 
-def decode_grid_from_fiducials(image_gray: np.ndarray, fiducials: dict) -> List[List[bool]]:
+def decode_grid_from_fiducials(binary: np.ndarray, fiducials: dict) -> List[List[bool]]:
     """
     Decode 7x7 grid using fiducials to determine grid bounds.
-    Uses dark pixel ratio analysis instead of single pixel sampling.
+    Uses dark pixel ratio analysis of the Otsu-thresholded image (dark = 1)
+    instead of single pixel sampling.
     Returns 2D list of booleans (True = stitch/dark, False = no stitch/light)
     """
     if 'tl' not in fiducials:
         raise ValueError("TL fiducial not found - cannot decode grid")
 
-    h, w = image_gray.shape
+    h, w = binary.shape
 
     # Get TL fiducial
     tl_x, tl_y, tl_w, tl_h = fiducials['tl']['bbox']
@@ -398,55 +951,100 @@ def decode_grid_from_fiducials(image_gray: np.ndarray, fiducials: dict) -> List[
         grid_left = tl_x + tl_w + int(fiducial_size * 0.1)
         grid_top = tl_y + tl_h + int(fiducial_size * 0.1)
 
-    # Get binary image using Otsu threshold
-    blurred = cv2.GaussianBlur(image_gray, (5, 5), 0)
-    _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    # Calculate dark pixel ratio for each cell from a summed-area table:
+    # one pass over the image, then four lookups per cell
+    sat = cv2.integral(binary)
 
-    grid = np.zeros((7, 7), dtype=bool)
-    scores = np.zeros((7, 7))
+    # Cell edges clipped to image bounds (cells outside the image score 0)
+    x_edges = np.clip(grid_left + cell_size * np.arange(8), 0, w)
+    y_edges = np.clip(grid_top + cell_size * np.arange(8), 0, h)
 
-    # Calculate dark pixel ratio for each cell
-    for row in range(7):
-        for col in range(7):
-            x1 = grid_left + col * cell_size
-            y1 = grid_top + row * cell_size
-            x2, y2 = x1 + cell_size, y1 + cell_size
+    corners = sat[y_edges[:, None], x_edges[None, :]]
+    dark_counts = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+    areas = np.maximum(np.diff(y_edges), 0)[:, None] * np.maximum(np.diff(x_edges), 0)[None, :]
+    scores = np.divide(dark_counts, areas, out=np.zeros((7, 7)), where=areas > 0)
 
-            # Clip to image bounds
-            x1c, x2c = max(0, x1), min(w, x2)
-            y1c, y2c = max(0, y1), min(h, y2)
+    # Adaptive threshold: midpoint of the largest gap between sorted scores
+    sorted_scores = np.sort(scores, axis=None)
+    gaps = np.diff(sorted_scores)
+    i = int(np.argmax(gaps))
+    threshold = (sorted_scores[i] + sorted_scores[i + 1]) / 2 if gaps[i] > 0 else 0.15
 
-            if x2c <= x1c or y2c <= y1c:
-                continue
+    # Clamp threshold to reasonable range
+    threshold = max(0.10, min(0.50, float(threshold)))
 
-            cell = binary[y1c:y2c, x1c:x2c]
-            dark_ratio = np.sum(cell > 0) / cell.size if cell.size > 0 else 0
-            scores[row, col] = dark_ratio
+    # Apply threshold; tolist() yields plain Python bools
+    return (scores > threshold).tolist()
 
-    # Adaptive threshold: find natural gap in scores
-    all_scores = sorted(scores.flatten())
-    best_gap = 0
-    threshold = 0.15  # Default fallback
 
-    for i in range(len(all_scores) - 1):
-        gap = all_scores[i + 1] - all_scores[i]
-        if gap > best_gap:
-            best_gap = gap
-            threshold = (all_scores[i] + all_scores[i + 1]) / 2
+def detect_pattern_sync(decode: Callable, data):
+    """
+    Blocking pattern pipeline: decode, threshold, find fiducials, decode grid.
+    Runs on CPU_EXECUTOR so the event loop stays free for other requests.
+    """
+    # Decode image straight to grayscale, at reduced scale for large JPEGs
+    image_gray = decode(data, cv2.IMREAD_GRAYSCALE, PATTERN_MAX_SIDE)
+
+    # Downscale large phone photos once; the whole pipeline runs at this size
+    scale = PATTERN_MAX_SIDE / max(image_gray.shape)
+    if scale < 1.0:
+        h, w = image_gray.shape
+        small = scratch_buffer("small", (round(h * scale), round(w * scale)))
+        image_gray = cv2.resize(image_gray, None, dst=small, fx=scale, fy=scale,
+                                interpolation=cv2.INTER_AREA)
+
+    # Otsu threshold once; shared by fiducial search and grid decoding
+    # (box blur is enough to denoise ahead of Otsu; fiducials and cells are
+    # far larger than the 5px kernel). The threshold runs in place on the
+    # blur output; nothing below keeps a reference past this request.
+    # Dark pixels are stored as 1, not 255, so the grid's summed-area table
+    # counts them directly.
+    binary = scratch_buffer("binary", image_gray.shape)
+    cv2.boxFilter(image_gray, -1, (5, 5), dst=binary, borderType=cv2.BORDER_REPLICATE)
+    cv2.threshold(binary, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU, dst=binary)
+
+    # Find fiducials using improved method
+    fiducials = find_fiducials(binary)
+    corners_found = len(fiducials)
 
-    # Clamp threshold to reasonable range
-    threshold = max(0.10, min(0.50, threshold))
+    if 'tl' not in fiducials:
+        print(f"TL fiducial not found ({corners_found} corners detected)")
+        # Same fields PatternDetectionResponse would dump, as a plain dict
+        return {
+            "grid": [[False] * 7 for _ in range(7)],
+            "confidence": 0.0,
+            "corner_markers_found": corners_found,
+            "debug_image": None
+        }
 
-    # Apply threshold to create boolean grid
-    for row in range(7):
-        for col in range(7):
-            grid[row, col] = scores[row, col] > threshold
+    # Decode grid using improved method
+    grid = decode_grid_from_fiducials(binary, fiducials)
 
-    # Convert to Python list with explicit bool conversion
-    return [[bool(cell) for cell in row] for row in grid.tolist()]
+    # Calculate confidence based on fiducials found
+    if corners_found == 4:
+        confidence = 1.0
+    elif corners_found >= 2:
+        confidence = 0.7
+    else:
+        confidence = 0.5
+
+    # Debug: Check grid data
+    filled_count = sum(sum(1 for cell in row if cell) for row in grid)
+    print(f"Pattern detected: {corners_found} corners, confidence: {confidence}, filled cells: {filled_count}/49")
+    print(f"Grid sample row 0: {grid[0]}")
+    print(f"Grid row 0 type check: {[type(c).__name__ for c in grid[0]]}")
+
+    # Return plain dict to bypass Pydantic serialization
+    response_data = {
+        "grid": grid,
+        "confidence": float(confidence),
+        "corner_markers_found": int(corners_found)
+    }
+    print(f"Response grid row 0: {response_data['grid'][0]}")
+    return response_data
 
 
-@app.post("/detect-pattern")
+@app.post("/detect-pattern", response_model=PatternDetectionResponse)
 async def detect_pattern(request: PatternDetectionRequest):
     """
     Detect embroidery pattern from photo and extract 7x7 grid.
@@ -458,49 +1056,33 @@ async def detect_pattern(request: PatternDetectionRequest):
     Returns:
         PatternDetectionResponse with grid and confidence
     """
-    try:
-        # Decode image
-        image = decode_base64_image(request.image)
-        image_np = np.array(image)
-        image_gray = cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
-
-        # Find fiducials using improved method
-        fiducials = find_fiducials(image_gray)
-        corners_found = len(fiducials)
-
-        if 'tl' not in fiducials:
-            print(f"TL fiducial not found ({corners_found} corners detected)")
-            return PatternDetectionResponse(
-                grid=[[False] * 7 for _ in range(7)],
-                confidence=0.0,
-                corner_markers_found=corners_found
-            )
+    return await run_pattern_detection(decode_base64_ndarray, request.image)
 
-        # Decode grid using improved method
-        grid = decode_grid_from_fiducials(image_gray, fiducials)
 
-        # Calculate confidence based on fiducials found
-        if corners_found == 4:
-            confidence = 1.0
-        elif corners_found >= 2:
-            confidence = 0.7
-        else:
-            confidence = 0.5
-
-        # Debug: Check grid data
-        filled_count = sum(sum(1 for cell in row if cell) for row in grid)
-        print(f"Pattern detected: {corners_found} corners, confidence: {confidence}, filled cells: {filled_count}/49")
-        print(f"Grid sample row 0: {grid[0]}")
-        print(f"Grid row 0 type check: {[type(c).__name__ for c in grid[0]]}")
-
-        # Return plain dict to bypass Pydantic serialization
-        response_data = {
-            "grid": grid,
-            "confidence": float(confidence),
-            "corner_markers_found": int(corners_found)
-        }
-        print(f"Response grid row 0: {response_data['grid'][0]}")
-        return response_data
+@app.post("/detect-pattern-bytes", response_model=PatternDetectionResponse)
+async def detect_pattern_bytes(file: UploadFile = File(...)):
+    """
+    Detect embroidery pattern from a photo uploaded as multipart/form-data.
+    Preferred over /detect-pattern: no base64 inflation or decode on either side.
+
+    Args:
+        file: Encoded image file (JPEG, PNG, ...)
+
+    Returns:
+        PatternDetectionResponse with grid and confidence
+    """
+    image_bytes = await file.read()
+    return await run_pattern_detection(decode_image_bytes, image_bytes)
+
+
+async def run_pattern_detection(decode: Callable, data):
+    """Run detect_pattern_sync on the CPU pool and map errors to HTTP responses"""
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            CPU_EXECUTOR, detect_pattern_sync, decode, data
+        )
+        # The result is plain JSON types already; skip jsonable_encoder
+        return ORJSONResponse(content=result)
 
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -519,4 +1101,5 @@ async def detect_pattern(request: PatternDetectionRequest):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 5001))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Each worker loads its own copy of the model; the default loop is uvloop when installed
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=WEB_CONCURRENCY)
@@ -9,22 +9,58 @@ import numpy as np
 ARUCO_DICT = cv2.aruco.DICT_4X4_50
 aruco_dict = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
 
-def generate_calibration_card_letter(marker_size_mm=100, dpi=300):
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Instruction lines shared by every card; None marks the size-specific line
+FIXED_INSTRUCTIONS = [
+    "PRINT AT 100% SCALE (ACTUAL SIZE) - DO NOT SCALE TO FIT",
+    None,
+    "Verify size with a ruler before using"
+]
+
+
+def draw_centered_text(page, text, y, scale, color, thickness):
+    """Draw text horizontally centered on the page at baseline y"""
+    text_size = cv2.getTextSize(text, FONT, scale, thickness)[0]
+    text_x = (page.shape[1] - text_size[0]) // 2
+    cv2.putText(page, text, (text_x, y), FONT, scale, color, thickness)
+
+
+def build_base_page_letter(dpi=300):
     """
-    Generate a letter-sized page (8.5" × 11") with 4 markers at corners
-    Ready to print at actual size
+    Create the white letter-sized canvas with the text common to every card
+    already drawn, so each marker size only copies it and adds its own parts
     """
     # Letter size in pixels at 300 DPI
     # 8.5" × 11" = 215.9mm × 279.4mm
     width_px = int(8.5 * dpi)   # 2550 pixels
     height_px = int(11 * dpi)   # 3300 pixels
 
+    page = np.full((height_px, width_px), 255, dtype=np.uint8)
+
+    y_offset = 160
+    for instruction in FIXED_INSTRUCTIONS:
+        if instruction is not None:
+            draw_centered_text(page, instruction, y_offset, 0.7, (0, 0, 0), 2)
+        y_offset += 40
+
+    return page
+
+
+def generate_calibration_card_letter(marker_size_mm=100, dpi=300, base_page=None):
+    """
+    Generate a letter-sized page (8.5" × 11") with 4 markers at corners
+    Ready to print at actual size
+    Pass base_page (from build_base_page_letter) to reuse it across sizes
+    """
+    if base_page is None:
+        base_page = build_base_page_letter(dpi)
+    page = base_page.copy()
+    height_px, width_px = page.shape
+
     # Convert marker size to pixels
     marker_size_px = int((marker_size_mm / 25.4) * dpi)
 
-    # Create white canvas
-    page = np.ones((height_px, width_px), dtype=np.uint8) * 255
-
     # Margin from edge
     margin_px = int((1.5 / 25.4) * dpi)  # 1.5 inch margin
 
@@ -46,25 +82,12 @@ def generate_calibration_card_letter(marker_size_mm=100, dpi=300):
         page[y:y+marker_size_px, x:x+marker_size_px] = marker
 
     # Add title at top center
-    font = cv2.FONT_HERSHEY_SIMPLEX
     title = f"ArUco Calibration Card - {marker_size_mm}mm markers"
-    title_size = cv2.getTextSize(title, font, 1.5, 3)[0]
-    title_x = (width_px - title_size[0]) // 2
-    cv2.putText(page, title, (title_x, 100), font, 1.5, (0, 0, 0), 3)
-
-    # Add instructions
-    instructions = [
-        "PRINT AT 100% SCALE (ACTUAL SIZE) - DO NOT SCALE TO FIT",
-        f"Each marker should measure exactly {marker_size_mm}mm × {marker_size_mm}mm",
-        "Verify size with a ruler before using"
-    ]
+    draw_centered_text(page, title, 100, 1.5, (0, 0, 0), 3)
 
-    y_offset = 160
-    for instruction in instructions:
-        text_size = cv2.getTextSize(instruction, font, 0.7, 2)[0]
-        text_x = (width_px - text_size[0]) // 2
-        cv2.putText(page, instruction, (text_x, y_offset), font, 0.7, (0, 0, 0), 2)
-        y_offset += 40
+    # Add the size-specific instruction (the others are on the base page)
+    instruction = f"Each marker should measure exactly {marker_size_mm}mm × {marker_size_mm}mm"
+    draw_centered_text(page, instruction, 160 + 40 * FIXED_INSTRUCTIONS.index(None), 0.7, (0, 0, 0), 2)
 
     # Add measurement guides (corner to corner distance)
     # Distance between marker centers (useful for validation)
@@ -76,9 +99,7 @@ def generate_calibration_card_letter(marker_size_mm=100, dpi=300):
     # Add dimension info at bottom
     dim_y = height_px - 80
     dim_text = f"Marker spacing: {center_distance_x_mm:.1f}mm × {center_distance_y_mm:.1f}mm (center to center)"
-    dim_size = cv2.getTextSize(dim_text, font, 0.6, 2)[0]
-    dim_x = (width_px - dim_size[0]) // 2
-    cv2.putText(page, dim_text, (dim_x, dim_y), font, 0.6, (100, 100, 100), 2)
+    draw_centered_text(page, dim_text, dim_y, 0.6, (100, 100, 100), 2)
 
     # Save
     filename = f"calibration_card_{marker_size_mm}mm_letter.png"
@@ -100,11 +121,14 @@ if __name__ == "__main__":
     # Generate multiple sizes for testing
     sizes = [10, 15, 20]  # mm
 
+    # Shared canvas with the fixed text, copied for each size
+    base_page = build_base_page_letter()
+
     for size in sizes:
         print(f"\n{'─' * 70}")
         print(f"Generating {size}mm markers...")
         print(f"{'─' * 70}")
-        generate_calibration_card_letter(marker_size_mm=size)
+        generate_calibration_card_letter(marker_size_mm=size, base_page=base_page)
 
     print("\n" + "=" * 70)
     print("✅ ALL CARDS GENERATED!")
@@ -12,6 +12,10 @@ aruco_dict = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
 aruco_params = cv2.aruco.DetectorParameters()
 detector = cv2.aruco.ArucoDetector(aruco_dict, aruco_params)
 
+# Live webcam frames are detected at this long side at most; the printed
+# markers stay well above the detector's minimum size at this resolution
+WEBCAM_DETECT_MAX_SIDE = 960
+
 def test_image(image_path):
     """Detect ArUco markers in an image and show results"""
     print(f"\n📷 Loading image: {image_path}")
@@ -122,6 +126,7 @@ def test_webcam():
     print("\nStarting live detection...\n")
 
     frame_count = 0
+    scale = None
 
     while True:
         ret, frame = cap.read()
@@ -129,9 +134,18 @@ def test_webcam():
             print("❌ Failed to grab frame")
             break
 
-        # Detect markers
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # Webcam resolution is fixed, so work out the detection scale once
+        if scale is None:
+            scale = min(1.0, WEBCAM_DETECT_MAX_SIDE / max(frame.shape[:2]))
+
+        # Detect markers on a downscaled copy, then map corners back to the frame
+        small = frame
+        if scale < 1.0:
+            small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
         corners, ids, rejected = detector.detectMarkers(gray)
+        if scale < 1.0:
+            corners = tuple(corner / scale for corner in corners)
 
         # Draw detected markers
         if ids is not None and len(ids) > 0:
@@ -8,22 +8,62 @@ Grid detection uses TL fiducial size to calculate cell size,
 then classifies cells by dark pixel ratio.
 
 Usage:
-    python 3_detect_pattern_stepwise.py path/to/image.jpg
+    python 3_detect_pattern_stepwise.py path/to/image.jpg [--no-debug]
 """
 
 import cv2
 import numpy as np
 import sys
 import os
+import heapq
+from functools import lru_cache
 from pathlib import Path
 
 DEBUG_DIR = "debug_output"
+# Write debug images (turned off with --no-debug)
+DEBUG = True
+# Longest side (at most) of the copy used to search for the pattern region
+REGION_MAX_SIDE = 800
+
+# Fast zlib level for debug PNGs (larger files, several times quicker to encode)
+_PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+# Run the large-image filters through OpenCV's T-API (UMat) when an
+# OpenCL device is available; results come back to host memory for contours
+USE_OPENCL = cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
+
+# 3x3 kernel for growing Canny edges into closed outlines
+KERNEL_3X3 = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+
+@lru_cache(maxsize=None)
+def _structuring_element(shape, size):
+    """Cached size x size structuring element (sizes scale with the image)"""
+    return cv2.getStructuringElement(shape, (size, size))
+
+
+def _largest_contours(contours, n=10):
+    """The n largest contours by area, largest first (each area computed once)"""
+    areas = [cv2.contourArea(c) for c in contours]
+    return [contours[i] for i in heapq.nlargest(n, range(len(contours)), key=areas.__getitem__)]
+
+
+def _to_device(img):
+    """Wrap img in a UMat so OpenCV filters run on the OpenCL device"""
+    return cv2.UMat(img) if USE_OPENCL else img
+
+
+def _to_host(img):
+    """NumPy array for img (downloads a UMat, passes arrays through)"""
+    return img.get() if isinstance(img, cv2.UMat) else img
 
 
 def save_debug(name, img):
-    """Save debug image"""
+    """Save debug image (no-op when DEBUG is off)"""
+    if not DEBUG:
+        return
     Path(DEBUG_DIR).mkdir(exist_ok=True)
-    cv2.imwrite(os.path.join(DEBUG_DIR, name), img)
+    cv2.imwrite(os.path.join(DEBUG_DIR, name), img, _PNG_PARAMS)
     print(f"  -> {name}")
 
 
@@ -32,19 +72,13 @@ def order_points(pts):
     Order points in consistent order: top-left, top-right, bottom-right, bottom-left.
     This is essential for perspective transform.
     """
-    rect = np.zeros((4, 2), dtype="float32")
-    
     # Sum of coordinates: smallest = top-left, largest = bottom-right
-    s = pts.sum(axis=1)
-    rect[0] = pts[np.argmin(s)]  # top-left
-    rect[2] = pts[np.argmax(s)]  # bottom-right
-    
-    # Difference of coordinates: smallest = top-right, largest = bottom-left
-    diff = np.diff(pts, axis=1)
-    rect[1] = pts[np.argmin(diff)]  # top-right
-    rect[3] = pts[np.argmax(diff)]  # bottom-left
+    s = pts[:, 0] + pts[:, 1]
+    # x - y: largest = top-right, smallest = bottom-left
+    d = pts[:, 0] - pts[:, 1]
     
-    return rect
+    # top-left, top-right, bottom-right, bottom-left
+    return pts[[np.argmin(s), np.argmax(d), np.argmax(s), np.argmin(d)]].astype("float32")
 
 
 def four_point_transform(image, pts):
@@ -52,17 +86,13 @@ def four_point_transform(image, pts):
     Apply perspective transform to crop and straighten the region defined by 4 points.
     """
     rect = order_points(pts)
-    (tl, tr, br, bl) = rect
-    
-    # Calculate width of new image (max of top and bottom widths)
-    width_top = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-    width_bottom = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-    max_width = max(int(width_top), int(width_bottom))
     
-    # Calculate height of new image (max of left and right heights)
-    height_left = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-    height_right = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-    max_height = max(int(height_left), int(height_right))
+    # Lengths of the top, bottom, left and right edges in one vector op;
+    # the new image takes the longer of each opposite pair
+    edges = rect[[1, 2, 3, 2]] - rect[[0, 3, 0, 1]]
+    lengths = np.hypot(edges[:, 0], edges[:, 1])
+    max_width = int(max(lengths[0], lengths[1]))
+    max_height = int(max(lengths[2], lengths[3]))
     
     # Destination points for the transform
     dst = np.array([
@@ -79,10 +109,117 @@ def four_point_transform(image, pts):
     return warped
 
 
+def _preprocess(image):
+    """
+    Grayscale + blur + inverted Otsu threshold, done once per image and
+    shared by every step that works on it.
+    Returns (blurred grayscale, binary) where dark pattern pixels are 255.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return blurred, binary
+
+
+def _largest_quad(mask, h, w):
+    """
+    First roughly square 4-sided outline among the largest contours of mask
+    (h x w), or None. Must cover at least 5% of the image, aspect < 1.5.
+    """
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    
+    for contour in _largest_contours(contours):
+        peri = cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
+        
+        # Look for 4-sided polygons
+        if len(approx) == 4:
+            # Must be at least 5% of image area
+            if cv2.contourArea(approx) < (h * w * 0.05):
+                continue
+            
+            x, y, cw, ch = cv2.boundingRect(approx)
+            aspect = max(cw, ch) / min(cw, ch) if min(cw, ch) > 0 else 999
+            
+            # Pattern should be roughly square (aspect < 1.5)
+            if aspect > 1.5:
+                continue
+            
+            return approx.reshape(4, 2)
+    return None
+
+
+def _closing_size(h, w):
+    """Odd closing kernel size for an h x w image (3% of the short side, at least 15)"""
+    kernel_size = max(15, int(min(h, w) * 0.03))
+    if kernel_size % 2 == 0:
+        kernel_size += 1
+    return kernel_size
+
+
+def _region_masks(blurred, binary, h, w):
+    """
+    The two masks searched for the pattern outline, built lazily:
+    Method 1 closes the inverted Otsu binary so the pattern merges into one
+    region (works well for dark patterns on light backgrounds), Method 2
+    (fallback) grows Canny edges into closed outlines.
+    Yields (name, mask) where name is None for Method 1 and "edges" for Method 2.
+    """
+    kernel = _structuring_element(cv2.MORPH_RECT, _closing_size(h, w))
+    yield None, _to_host(cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel))
+    
+    edges = cv2.Canny(blurred, 50, 150)
+    yield "edges", _to_host(cv2.dilate(edges, KERNEL_3X3, iterations=2))
+
+
+def _refine_corners(pts, make_mask, shape, radius, margin):
+    """
+    Snap corners found on the downscaled copy to the full-resolution outline.
+    make_mask(y0, y1, x0, x1) builds the search mask for one window; margin
+    covers how far the mask filter reaches, so the window interior matches
+    the full-image mask. Within radius of each corner the outline point lying
+    farthest out from the line through its two neighbours is taken, which is
+    the vertex approxPolyDP picks for that corner at full resolution.
+    """
+    h, w = shape
+    refined = np.empty((4, 2), dtype=np.int32)
+    for i, corner in enumerate(pts):
+        cx, cy = int(round(corner[0])), int(round(corner[1]))
+        x0, y0 = max(0, cx - radius - margin), max(0, cy - radius - margin)
+        x1, y1 = min(w, cx + radius + margin + 1), min(h, cy + radius + margin + 1)
+        contours, _ = cv2.findContours(make_mask(y0, y1, x0, x1), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        if not contours:
+            return None
+        outline = np.vstack(contours).reshape(-1, 2) + (x0, y0)
+        outline = outline[np.abs(outline - (cx, cy)).max(axis=1) <= radius]
+        if len(outline) == 0:
+            return None
+        
+        # Outward normal of the neighbours' chord
+        prev, nxt = pts[i - 1], pts[(i + 1) % 4]
+        normal = np.array([nxt[1] - prev[1], prev[0] - nxt[0]])
+        if np.dot(corner - prev, normal) < 0:
+            normal = -normal
+        refined[i] = outline[np.argmax((outline - prev) @ normal)]
+    return refined
+
+
+def _shrink(img, factor, small_h, small_w):
+    """Downscale img by a whole factor, averaging factor x factor blocks"""
+    if isinstance(img, cv2.UMat):
+        img = cv2.UMat(img, (0, small_h * factor), (0, small_w * factor))
+    else:
+        img = img[:small_h * factor, :small_w * factor]
+    return cv2.resize(img, (small_w, small_h), interpolation=cv2.INTER_AREA)
+
+
 def find_pattern_region(image):
     """
     Find the pattern region in an image where the pattern may not fill the entire frame.
     Uses edge detection and contour finding to locate the largest rectangular region.
+    The outline search runs on a copy downscaled to REGION_MAX_SIDE and the
+    corners it finds are refined in small full-resolution windows; the full
+    image is only searched when the copy finds nothing.
     
     Returns:
         - Cropped image if pattern region found
@@ -94,85 +231,59 @@ def find_pattern_region(image):
     h, w = image.shape[:2]
     print(f"  Image size: {w}x{h}")
     
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    blurred, binary = _preprocess(_to_device(image))
+    # Shrink by a whole factor: INTER_AREA then averages exact pixel blocks,
+    # several times faster than at a fractional ratio
+    factor = -(-max(h, w) // REGION_MAX_SIDE)
     
     pattern_pts = None
-    debug_img = image.copy()
-    
-    # Method 1: Inverted binary threshold + morphological closing
-    # This works well for dark patterns on light backgrounds
-    _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    
-    # Close gaps to merge pattern elements into a single region
-    kernel_size = max(15, int(min(h, w) * 0.03))
-    if kernel_size % 2 == 0:
-        kernel_size += 1
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-    closed = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
-    
-    save_debug("0a_binary_closed.png", closed)
-    
-    contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-    if contours:
-        contours = sorted(contours, key=cv2.contourArea, reverse=True)
+    method = None
+    
+    if factor > 1:
+        # Trailing rows/columns that don't fill a whole block are dropped
+        small_h, small_w = h // factor, w // factor
+        small_blurred = _shrink(blurred, factor, small_h, small_w)
+        small_binary = _shrink(binary, factor, small_h, small_w)
+        _, small_binary = cv2.threshold(small_binary, 127, 255, cv2.THRESH_BINARY)
         
-        for contour in contours[:10]:
-            peri = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
-            
-            # Look for 4-sided polygons
-            if len(approx) == 4:
-                area = cv2.contourArea(approx)
-                # Must be at least 5% of image area
-                if area < (h * w * 0.05):
-                    continue
-                
-                x, y, cw, ch = cv2.boundingRect(approx)
-                aspect = max(cw, ch) / min(cw, ch) if min(cw, ch) > 0 else 999
-                
-                # Pattern should be roughly square (aspect < 1.5)
-                if aspect > 1.5:
-                    continue
-                
-                pattern_pts = approx.reshape(4, 2)
-                cv2.drawContours(debug_img, [approx], -1, (0, 255, 0), 3)
-                print(f"  Found pattern region: {cw}x{ch}, aspect {aspect:.2f}, area {area}")
+        for method, mask in _region_masks(small_blurred, small_binary, small_h, small_w):
+            save_debug("0a_edges.png" if method else "0a_binary_closed.png", mask)
+            approx = _largest_quad(mask, small_h, small_w)
+            if approx is not None:
                 break
+        
+        if approx is not None:
+            # Rebuild the same mask around each corner at full resolution
+            blurred_host, binary_host = _to_host(blurred), _to_host(binary)
+            kernel_size = _closing_size(h, w)
+            if method is None:
+                kernel = _structuring_element(cv2.MORPH_RECT, kernel_size)
+                make_mask = lambda y0, y1, x0, x1: cv2.morphologyEx(
+                    binary_host[y0:y1, x0:x1], cv2.MORPH_CLOSE, kernel)
+            else:
+                make_mask = lambda y0, y1, x0, x1: cv2.dilate(
+                    cv2.Canny(blurred_host[y0:y1, x0:x1], 50, 150), KERNEL_3X3, iterations=2)
+            # Upscaled corners land within a few small-copy pixels of the outline
+            pattern_pts = _refine_corners(approx * factor, make_mask, (h, w),
+                                          4 * factor, kernel_size)
     
-    # Method 2: Canny edge detection (fallback)
     if pattern_pts is None:
-        edges = cv2.Canny(blurred, 50, 150)
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-        edges = cv2.dilate(edges, kernel, iterations=2)
-        
-        save_debug("0a_edges.png", edges)
-        
-        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        if contours:
-            contours = sorted(contours, key=cv2.contourArea, reverse=True)
-            
-            for contour in contours[:10]:
-                peri = cv2.arcLength(contour, True)
-                approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
-                
-                if len(approx) == 4:
-                    area = cv2.contourArea(approx)
-                    if area < (h * w * 0.05):
-                        continue
-                    
-                    x, y, cw, ch = cv2.boundingRect(approx)
-                    aspect = max(cw, ch) / min(cw, ch) if min(cw, ch) > 0 else 999
-                    
-                    if aspect > 1.5:
-                        continue
-                    
-                    pattern_pts = approx.reshape(4, 2)
-                    cv2.drawContours(debug_img, [approx], -1, (0, 255, 0), 3)
-                    print(f"  Found pattern region (edges): {cw}x{ch}, aspect {aspect:.2f}")
-                    break
+        for method, mask in _region_masks(blurred, binary, h, w):
+            save_debug("0a_edges.png" if method else "0a_binary_closed.png", mask)
+            pattern_pts = _largest_quad(mask, h, w)
+            if pattern_pts is not None:
+                break
+    
+    debug_img = image.copy() if DEBUG else None
+    if pattern_pts is not None:
+        x, y, cw, ch = cv2.boundingRect(pattern_pts)
+        aspect = max(cw, ch) / min(cw, ch) if min(cw, ch) > 0 else 999
+        if DEBUG:
+            cv2.drawContours(debug_img, [pattern_pts.reshape(-1, 1, 2)], -1, (0, 255, 0), 3)
+        if method is None:
+            print(f"  Found pattern region: {cw}x{ch}, aspect {aspect:.2f}, area {cv2.contourArea(pattern_pts)}")
+        else:
+            print(f"  Found pattern region (edges): {cw}x{ch}, aspect {aspect:.2f}")
     
     save_debug("0b_pattern_region.png", debug_img)
     
@@ -190,10 +301,11 @@ def find_pattern_region(image):
     return cropped, pattern_pts
 
 
-def find_fiducials(image):
+def find_fiducials(image, binary):
     """
     Find the 4 corner fiducials by position.
     Searches each corner region separately for the largest shape.
+    Takes the image's Otsu binary from _preprocess (left unmodified).
     Returns dict with {tl, tr, bl, br} containing bounding box info.
     """
     print("\n[STEP 1] Finding fiducials...")
@@ -201,10 +313,6 @@ def find_fiducials(image):
     h, w = image.shape[:2]
     print(f"  Image size: {w}x{h}")
     
-    # Use Otsu threshold
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
     save_debug("1_binary.png", binary)
 
     # Apply morphological closing only for larger images (photos with texture)
@@ -213,8 +321,8 @@ def find_fiducials(image):
         kernel_size = max(3, int(min(h, w) * 0.008))
         if kernel_size % 2 == 0:
             kernel_size += 1
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
-        binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+        kernel = _structuring_element(cv2.MORPH_ELLIPSE, kernel_size)
+        binary = _to_host(cv2.morphologyEx(_to_device(binary), cv2.MORPH_CLOSE, kernel))
         save_debug("1b_binary_closed.png", binary)
         print(f"  Applied morphological closing with kernel size: {kernel_size}px")
     else:
@@ -232,29 +340,33 @@ def find_fiducials(image):
     }
     
     fiducials = {}
-    debug_img = image.copy()
     
     for corner, (y1, y2, x1, x2) in corners.items():
-        # Extract corner region from binary image
+        # Extract corner region from binary image (a view, not a copy)
         region = binary[y1:y2, x1:x2]
         
-        # Find contours in this region
-        contours, _ = cv2.findContours(region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Thin or tiny images leave an empty corner; labelling a 0x0 image
+        # crashes OpenCV, so report it as missing instead
+        if margin <= 0 or region.size == 0:
+            print(f"  {corner.upper()}: Not found (empty corner region)")
+            continue
         
-        if not contours:
-            print(f"  {corner.upper()}: Not found (no contours)")
+        # Label blobs in this region; one pass gives every bounding box and area.
+        # Labelling per corner (not the whole image) keeps a fiducial separate
+        # from pattern stitches that happen to touch it.
+        n, _, stats, _ = cv2.connectedComponentsWithStats(region, connectivity=8, ltype=cv2.CV_32S)
+        
+        if n <= 1:
+            print(f"  {corner.upper()}: Not found (no blobs)")
             continue
 
-        # Merge nearby contours if multiple exist
-        if len(contours) > 1:
-            # Sort by area and take top 3
-            contours_sorted = sorted(contours, key=cv2.contourArea, reverse=True)[:3]
-            # Merge all top contours into single bounding box
-            all_points = np.vstack(contours_sorted)
-            bx, by, bw, bh = cv2.boundingRect(all_points)
-        else:
-            best = max(contours, key=cv2.contourArea)
-            bx, by, bw, bh = cv2.boundingRect(best)
+        # Merge nearby blobs: union of the bounding boxes of the top 3 by area
+        blobs = stats[1:]  # label 0 is the background
+        top = blobs[np.argsort(-blobs[:, cv2.CC_STAT_AREA], kind="stable")[:3]]
+        bx = int(top[:, cv2.CC_STAT_LEFT].min())
+        by = int(top[:, cv2.CC_STAT_TOP].min())
+        bw = int((top[:, cv2.CC_STAT_LEFT] + top[:, cv2.CC_STAT_WIDTH]).max()) - bx
+        bh = int((top[:, cv2.CC_STAT_TOP] + top[:, cv2.CC_STAT_HEIGHT]).max()) - by
         
         # Adjust coordinates back to full image
         bx += x1
@@ -270,13 +382,14 @@ def find_fiducials(image):
         fiducials = normalize_fiducial_sizes(fiducials)
     
     # Draw on debug image
-    for corner, fid in fiducials.items():
-        bx, by, bw, bh = fid['bbox']
-        cv2.rectangle(debug_img, (bx, by), (bx+bw, by+bh), (0, 255, 0), 3)
-        cv2.putText(debug_img, corner.upper(), (bx, by-10), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-    
-    save_debug("2_fiducials.png", debug_img)
+    if DEBUG:
+        debug_img = image.copy()
+        for corner, fid in fiducials.items():
+            bx, by, bw, bh = fid['bbox']
+            cv2.rectangle(debug_img, (bx, by), (bx+bw, by+bh), (0, 255, 0), 3)
+            cv2.putText(debug_img, corner.upper(), (bx, by-10), 
+                       cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+        save_debug("2_fiducials.png", debug_img)
     return fiducials
 
 
@@ -330,10 +443,11 @@ def normalize_fiducial_sizes(fiducials):
     return normalized
 
 
-def decode_grid(image, fiducials):
+def decode_grid(image, fiducials, binary):
     """
     Decode 7x7 grid using fiducials to determine grid bounds.
     Uses all available fiducials for more robust calculation.
+    Takes the same Otsu binary from _preprocess that find_fiducials used.
     """
     print("\n[STEP 2] Decoding grid...")
     
@@ -378,67 +492,55 @@ def decode_grid(image, fiducials):
     print(f"  Cell size: {cell_size}px")
     print(f"  Grid starts at: ({grid_left}, {grid_top})")
     
-    # Get binary image for classification
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    # Binary image for classification
     save_debug("3_binary_grid.png", binary)
     
-    grid = np.zeros((7, 7), dtype=bool)
     scores = np.zeros((7, 7))
-    debug_img = image.copy()
     
-    # Draw fiducial references
-    for corner, fid in fiducials.items():
-        fx, fy, fw, fh = fid['bbox']
-        cv2.rectangle(debug_img, (fx, fy), (fx+fw, fy+fh), (0, 0, 255), 2)
+    # Calculate dark pixel ratio for each cell from a summed-area table:
+    # one pass over the image, then four lookups per cell
+    sat = cv2.integral((binary > 0).view(np.uint8))
     
-    for row in range(7):
-        for col in range(7):
-            x1 = grid_left + col * cell_size
-            y1 = grid_top + row * cell_size
-            x2, y2 = x1 + cell_size, y1 + cell_size
-            
-            # Clip to image bounds
-            x1c, x2c = max(0, x1), min(w, x2)
-            y1c, y2c = max(0, y1), min(h, y2)
-            
-            if x2c <= x1c or y2c <= y1c:
-                continue
-            
-            # Calculate dark pixel ratio
-            cell = binary[y1c:y2c, x1c:x2c]
-            dark_ratio = np.sum(cell > 0) / cell.size if cell.size > 0 else 0
-            scores[row, col] = dark_ratio
+    # Cell edges clipped to image bounds (cells outside the image score 0)
+    xs = grid_left + cell_size * np.arange(8)
+    ys = grid_top + cell_size * np.arange(8)
+    x_edges = np.clip(xs, 0, w)
+    y_edges = np.clip(ys, 0, h)
+    
+    corners = sat[y_edges[:, None], x_edges[None, :]]
+    dark_counts = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+    areas = np.maximum(np.diff(y_edges), 0)[:, None] * np.maximum(np.diff(x_edges), 0)[None, :]
+    np.divide(dark_counts, areas, out=scores, where=areas > 0)
     
     # Adaptive threshold: find natural gap in scores
-    all_scores = sorted(scores.flatten())
-    # Find largest gap in sorted scores to determine threshold
-    best_gap = 0
-    threshold = 0.15  # Default fallback
-    for i in range(len(all_scores) - 1):
-        gap = all_scores[i + 1] - all_scores[i]
-        if gap > best_gap:
-            best_gap = gap
-            threshold = (all_scores[i] + all_scores[i + 1]) / 2
+    # (midpoint of the largest gap between sorted scores; 0.15 if all equal)
+    all_scores = np.sort(scores, axis=None)
+    gaps = np.diff(all_scores)
+    i = int(np.argmax(gaps))
+    threshold = (all_scores[i] + all_scores[i + 1]) / 2 if gaps[i] > 0 else 0.15
     
     # Ensure threshold is reasonable (between 10% and 50%)
-    threshold = max(0.10, min(0.50, threshold))
+    threshold = max(0.10, min(0.50, float(threshold)))
     print(f"  Adaptive threshold: {threshold:.3f}")
     
-    for row in range(7):
-        for col in range(7):
-            x1 = grid_left + col * cell_size
-            y1 = grid_top + row * cell_size
-            x2, y2 = x1 + cell_size, y1 + cell_size
-            
-            grid[row, col] = scores[row, col] > threshold
-            
-            # Draw cell
-            color = (0, 255, 0) if grid[row, col] else (100, 100, 100)
-            cv2.rectangle(debug_img, (x1, y1), (x2, y2), color, 2)
+    grid = scores > threshold
     
-    save_debug("4_grid_result.png", debug_img)
+    if DEBUG:
+        debug_img = image.copy()
+        
+        # Draw fiducial references
+        for corner, fid in fiducials.items():
+            fx, fy, fw, fh = fid['bbox']
+            cv2.rectangle(debug_img, (fx, fy), (fx+fw, fy+fh), (0, 0, 255), 2)
+        
+        # Draw cells (unclipped edges, as laid out on the pattern)
+        for row in range(7):
+            for col in range(7):
+                color = (0, 255, 0) if grid[row, col] else (100, 100, 100)
+                cv2.rectangle(debug_img, (int(xs[col]), int(ys[row])),
+                              (int(xs[col + 1]), int(ys[row + 1])), color, 2)
+        
+        save_debug("4_grid_result.png", debug_img)
     
     print(f"  Score range: {scores.min():.3f} - {scores.max():.3f}")
     print(f"  Filled cells: {np.sum(grid)}/49")
@@ -472,23 +574,29 @@ def grid_to_binary(grid):
     Convert grid to binary string, skipping corner cells.
     Reads row-by-row, left-to-right.
     """
-    binary = ""
+    grid = np.asarray(grid, dtype=bool)
     grid_size = len(grid)
     
-    for row in range(grid_size):
-        for col in range(grid_size):
-            # Skip corner cells
-            is_corner = (
-                (row == 0 and col == 0) or
-                (row == 0 and col == grid_size - 1) or
-                (row == grid_size - 1 and col == 0) or
-                (row == grid_size - 1 and col == grid_size - 1)
-            )
-            
-            if not is_corner:
-                binary += "1" if grid[row, col] else "0"
+    # Drop the four corner cells (fiducials, not data) from the flat grid
+    corners = [0, grid_size - 1, grid_size * (grid_size - 1), grid_size * grid_size - 1]
+    bits = np.delete(grid.ravel(), corners)
     
-    return binary
+    # '0' + bit gives the ASCII digit for each cell
+    return (bits.view(np.uint8) + ord("0")).tobytes().decode("ascii")
+
+
+def binary_to_codes(binary, id_length=6):
+    """
+    Split the binary string into id_length 7-bit ASCII codes (missing
+    trailing bits read as 0). Returns an int array.
+    """
+    n_bits = id_length * 7
+    bits = np.zeros(n_bits, dtype=np.int64)
+    digits = np.frombuffer(binary[:n_bits].encode("ascii"), dtype=np.uint8) - ord("0")
+    bits[:len(digits)] = digits
+    
+    # MSB first within each 7-bit chunk
+    return bits.reshape(id_length, 7) @ (1 << np.arange(6, -1, -1))
 
 
 def binary_to_id(binary, id_length=6):
@@ -496,17 +604,8 @@ def binary_to_id(binary, id_length=6):
     Convert binary string to ID.
     Each 7 bits → one ASCII character.
     """
-    chars = []
-    
-    for i in range(0, id_length * 7, 7):
-        chunk = binary[i:i+7]
-        # Pad with zeros if needed
-        padded_chunk = chunk.ljust(7, '0')
-        ascii_code = int(padded_chunk, 2)
-        if ascii_code > 0:  # Only add printable characters
-            chars.append(chr(ascii_code))
-    
-    return "".join(chars)
+    # Only add non-zero codes
+    return "".join(chr(code) for code in binary_to_codes(binary, id_length) if code > 0)
 
 
 def decode_id(grid):
@@ -517,9 +616,8 @@ def decode_id(grid):
     print("ID DECODING:")
     print(f"  Binary (45 bits, no corners): {binary}")
     print(f"  Chunks (7 bits each):")
-    for i in range(6):
+    for i, ascii_code in enumerate(binary_to_codes(binary)):
         chunk = binary[i*7:(i+1)*7]
-        ascii_code = int(chunk.ljust(7, '0'), 2)
         char = chr(ascii_code) if 32 <= ascii_code < 127 else '?'
         print(f"    Bits {i*7+1}-{(i+1)*7}: {chunk} → {ascii_code:3d} → '{char}'")
     
@@ -532,17 +630,23 @@ def decode_id(grid):
 
 
 def main():
+    global DEBUG
+    
     if len(sys.argv) < 2:
-        print("Usage: python 3_detect_pattern_stepwise.py path/to/image.jpg")
+        print("Usage: python 3_detect_pattern_stepwise.py path/to/image.jpg [--no-debug]")
         sys.exit(1)
     
     image_path = sys.argv[1]
+    DEBUG = "--no-debug" not in sys.argv
     if not os.path.exists(image_path):
         print(f"Error: Image not found: {image_path}")
         sys.exit(1)
     
     print(f"\nProcessing: {image_path}")
-    print(f"Debug output: {DEBUG_DIR}/\n")
+    if DEBUG:
+        print(f"Debug output: {DEBUG_DIR}/\n")
+    else:
+        print()
     
     image = cv2.imread(image_path)
     if image is None:
@@ -557,10 +661,12 @@ def main():
         cropped_image, pattern_pts = find_pattern_region(image)
         
         # Use the cropped image for further processing
+        # (thresholded once; reused by every step that works on it)
         working_image = cropped_image
+        _, binary = _preprocess(working_image)
         
         # Step 1: Find all 4 fiducials
-        fiducials = find_fiducials(working_image)
+        fiducials = find_fiducials(working_image, binary)
         
         found = list(fiducials.keys())
         missing = [k for k in ['tl', 'tr', 'bl', 'br'] if k not in fiducials]
@@ -575,14 +681,17 @@ def main():
             print(f"\n✓ Found all 4 fiducials")
         
         # Step 2: Decode grid using fiducials
-        grid, scores = decode_grid(working_image, fiducials)
+        grid, scores = decode_grid(working_image, fiducials, binary)
         
         # Print results
         print_grid(grid)
         print_grid_binary(grid)
         decode_id(grid)
         
-        print(f"\n✓ Done! Check '{DEBUG_DIR}/' for debug images.")
+        if DEBUG:
+            print(f"\n✓ Done! Check '{DEBUG_DIR}/' for debug images.")
+        else:
+            print("\n✓ Done!")
         
     except Exception as e:
         print(f"\nError: {e}")
@@ -8,7 +8,7 @@ Approach:
 4. Classify each cell by dark pixel ratio (>15% = filled)
 
 Usage:
-    python detect_pattern_simple.py image.jpg [--debug]
+    python detect_pattern_simple.py image.jpg [more.jpg ...] [--debug]
 """
 
 import cv2
@@ -42,90 +42,116 @@ def find_tl_fiducial(binary, image_shape):
     return x, y, fw, fh
 
 
-def detect_grid(image_path, debug=False):
+class PatternDetector:
     """
-    Detect the 7x7 grid pattern in an embroidered image.
-    
-    Returns:
-        grid: 7x7 numpy array of booleans (True = X present)
-        scores: 7x7 numpy array of dark pixel ratios
+    Reusable 7x7 grid detector for processing many images in one run.
+    Keeps its grayscale, blur, threshold and integral images between calls
+    and only reallocates one when the image size changes.
     """
-    # Load image
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError(f"Could not load image: {image_path}")
-    
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    h, w = gray.shape
-    
-    # Binary threshold (dark embroidery on light fabric)
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    
-    # Find TL fiducial
-    fx, fy, fw, fh = find_tl_fiducial(binary, image.shape)
     
-    # Calculate cell size from fiducial
-    # The fiducial is approximately 75-80% of cell size
-    fiducial_size = (fw + fh) // 2
-    cell_size = int(fiducial_size * 1.30)
+    def __init__(self):
+        self._buffers = {}
     
-    # Grid starts at bottom-right of fiducial + small offset
-    offset = int(fiducial_size * 0.1)
-    grid_start_x = fx + fw + offset
-    grid_start_y = fy + fh + offset
+    def _buffer(self, name, shape, dtype=np.uint8):
+        """Return the scratch buffer called name, reallocated on a shape change"""
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+        return buf
     
-    # Classify each cell
-    grid = np.zeros((7, 7), dtype=bool)
-    scores = np.zeros((7, 7))
-    
-    for row in range(7):
-        for col in range(7):
-            x1 = grid_start_x + col * cell_size
-            y1 = grid_start_y + row * cell_size
-            x2 = x1 + cell_size
-            y2 = y1 + cell_size
+    def detect(self, image, debug=False):
+        """
+        Detect the 7x7 grid pattern in a loaded BGR image.
+        
+        Returns:
+            grid: 7x7 numpy array of booleans (True = X present)
+            scores: 7x7 numpy array of dark pixel ratios
+        """
+        h, w = image.shape[:2]
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._buffer("gray", (h, w)))
+        
+        # Binary threshold (dark embroidery on light fabric), stored as 0/1
+        # so the summed-area table below counts dark pixels directly
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0, dst=self._buffer("blurred", (h, w)))
+        _, binary = cv2.threshold(blurred, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU,
+                                  dst=self._buffer("binary", (h, w)))
+        
+        # Find TL fiducial
+        fx, fy, fw, fh = find_tl_fiducial(binary, image.shape)
+        
+        # Calculate cell size from fiducial
+        # The fiducial is approximately 75-80% of cell size
+        fiducial_size = (fw + fh) // 2
+        cell_size = int(fiducial_size * 1.30)
+        
+        # Grid starts at bottom-right of fiducial + small offset
+        offset = int(fiducial_size * 0.1)
+        grid_start_x = fx + fw + offset
+        grid_start_y = fy + fh + offset
+        
+        # Dark pixel ratio of each cell from a summed-area table: one pass
+        # over the image, then four lookups per cell
+        sat = cv2.integral(binary, sum=self._buffer("sat", (h + 1, w + 1), np.int32),
+                           sdepth=cv2.CV_32S)
+        
+        # Cell edges clipped to image bounds (cells outside the image score 0)
+        x_edges = np.clip(grid_start_x + cell_size * np.arange(8), 0, w)
+        y_edges = np.clip(grid_start_y + cell_size * np.arange(8), 0, h)
+        
+        corners = sat[y_edges[:, None], x_edges[None, :]]
+        dark_counts = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+        areas = np.maximum(np.diff(y_edges), 0)[:, None] * np.maximum(np.diff(x_edges), 0)[None, :]
+        scores = np.divide(dark_counts, areas, out=np.zeros((7, 7)), where=areas > 0)
+        
+        # Threshold: >15% dark pixels means X is present
+        grid = scores > 0.15
+        
+        # Save debug visualization if requested
+        if debug:
+            debug_dir = Path("debug_output")
+            debug_dir.mkdir(exist_ok=True)
             
-            # Clip to image bounds
-            x1, x2 = max(0, x1), min(w, x2)
-            y1, y2 = max(0, y1), min(h, y2)
+            viz = image.copy()
             
-            if x2 <= x1 or y2 <= y1:
-                continue
+            # Draw fiducial box
+            cv2.rectangle(viz, (fx, fy), (fx + fw, fy + fh), (0, 0, 255), 3)
             
-            # Calculate dark pixel ratio
-            cell = binary[y1:y2, x1:x2]
-            dark_ratio = np.sum(cell > 0) / cell.size if cell.size > 0 else 0
-            scores[row, col] = dark_ratio
+            # Draw grid
+            for row in range(7):
+                for col in range(7):
+                    x1 = grid_start_x + col * cell_size
+                    y1 = grid_start_y + row * cell_size
+                    x2 = x1 + cell_size
+                    y2 = y1 + cell_size
+                    
+                    color = (0, 255, 0) if grid[row, col] else (128, 128, 128)
+                    cv2.rectangle(viz, (x1, y1), (x2, y2), color, 2)
             
-            # Threshold: >15% dark pixels means X is present
-            grid[row, col] = dark_ratio > 0.15
-    
-    # Save debug visualization if requested
-    if debug:
-        debug_dir = Path("debug_output")
-        debug_dir.mkdir(exist_ok=True)
-        
-        viz = image.copy()
+            cv2.imwrite(str(debug_dir / "detection_result.png"), viz,
+                        [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            print(f"Debug image saved to {debug_dir}/detection_result.png")
         
-        # Draw fiducial box
-        cv2.rectangle(viz, (fx, fy), (fx + fw, fy + fh), (0, 0, 255), 3)
-        
-        # Draw grid
-        for row in range(7):
-            for col in range(7):
-                x1 = grid_start_x + col * cell_size
-                y1 = grid_start_y + row * cell_size
-                x2 = x1 + cell_size
-                y2 = y1 + cell_size
-                
-                color = (0, 255, 0) if grid[row, col] else (128, 128, 128)
-                cv2.rectangle(viz, (x1, y1), (x2, y2), color, 2)
-        
-        cv2.imwrite(str(debug_dir / "detection_result.png"), viz)
-        print(f"Debug image saved to {debug_dir}/detection_result.png")
+        return grid, scores
+
+
+def detect_grid(image_path, debug=False, detector=None):
+    """
+    Detect the 7x7 grid pattern in an embroidered image file.
+    Pass a PatternDetector to reuse its buffers across images.
+    
+    Returns:
+        grid: 7x7 numpy array of booleans (True = X present)
+        scores: 7x7 numpy array of dark pixel ratios
+    """
+    # Load image
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Could not load image: {image_path}")
     
-    return grid, scores
+    if detector is None:
+        detector = PatternDetector()
+    return detector.detect(image, debug=debug)
 
 
 def print_grid(grid):
@@ -141,30 +167,40 @@ def print_grid(grid):
 
 
 def main():
-    if len(sys.argv) < 2:
+    image_paths = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not image_paths:
         print(__doc__)
         sys.exit(1)
     
-    image_path = sys.argv[1]
     debug = "--debug" in sys.argv
+    detector = PatternDetector()
+    failed = False
     
-    if not os.path.exists(image_path):
-        print(f"Error: Image not found: {image_path}")
-        sys.exit(1)
-    
-    try:
-        grid, scores = detect_grid(image_path, debug=debug)
-        print_grid(grid)
+    for image_path in image_paths:
+        if len(image_paths) > 1:
+            print(f"\n=== {image_path} ===")
         
-        # Print statistics
-        filled = np.sum(grid)
-        print(f"Filled cells: {filled}/49")
-        print(f"Score range: {scores.min():.3f} - {scores.max():.3f}")
+        if not os.path.exists(image_path):
+            print(f"Error: Image not found: {image_path}")
+            failed = True
+            continue
         
-    except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
+        try:
+            grid, scores = detect_grid(image_path, debug=debug, detector=detector)
+            print_grid(grid)
+            
+            # Print statistics
+            filled = np.sum(grid)
+            print(f"Filled cells: {filled}/49")
+            print(f"Score range: {scores.min():.3f} - {scores.max():.3f}")
+            
+        except Exception as e:
+            print(f"Error: {e}")
+            import traceback
+            traceback.print_exc()
+            failed = True
+    
+    if failed:
         sys.exit(1)
 
 
@@ -4,25 +4,28 @@
  */
 
 import type { Detection } from '$lib/types/mend';
+import { base64ToBlob } from '$lib/utils/imageUtils';
 
 /**
  * YOLOv8 damage detection via FastAPI backend
  * Sends image to API and returns detection with highest confidence
+ *
+ * Uploads raw image bytes as multipart/form-data (`/detect-bytes`), which is
+ * preferred over the legacy base64 JSON `/detect` endpoint: ~33% smaller
+ * request and no base64 decode on the server.
  */
 export async function detectDamage(base64Image: string, confidenceThreshold = 0.3): Promise<Detection | null> {
 	// Get API URL from environment variable (defaults to localhost for dev)
 	const apiUrl = import.meta.env.VITE_API_URL || 'http://localhost:5001';
 
 	try {
-		const response = await fetch(`${apiUrl}/detect`, {
+		const formData = new FormData();
+		formData.append('file', await base64ToBlob(base64Image), 'image.jpg');
+		formData.append('confidence_threshold', String(confidenceThreshold));
+
+		const response = await fetch(`${apiUrl}/detect-bytes`, {
 			method: 'POST',
-			headers: {
-				'Content-Type': 'application/json'
-			},
-			body: JSON.stringify({
-				image: base64Image,
-				confidence_threshold: confidenceThreshold
-			})
+			body: formData
 		});
 
 		if (!response.ok) {
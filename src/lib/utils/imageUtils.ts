@@ -20,6 +20,15 @@ export async function blobToBase64(blob: Blob): Promise<string> {
 	});
 }
 
+/**
+ * Convert a base64 data URL back to a Blob (e.g. for multipart uploads)
+ */
+export async function base64ToBlob(base64: string): Promise<Blob> {
+	const dataUrl = base64.startsWith('data:') ? base64 : `data:image/jpeg;base64,${base64}`;
+	const response = await fetch(dataUrl);
+	return response.blob();
+}
+
 /**
  * Resize an image to maximum dimensions while maintaining aspect ratio
  */